@@ -29,10 +29,16 @@ from lausanne_heat_islands.invest import utils as invest_utils
 @click.option('--x0-w-eti', type=float, default=0.2)
 @click.option('--metric', default='R2')
 @click.option('--stepsize', type=float, default=0.3)
+@click.option('--num-candidates', type=click.IntRange(min=1), default=1)
+@click.option('--num-chains', type=click.IntRange(min=1), default=1)
+@click.option('--x0-stepsize', type=float)
+@click.option('--num-workers', type=int)
+@click.option('--seed', type=int)
 def main(agglom_lulc_filepath, biophysical_table_filepath, ref_et_filepath,
          station_locations_filepath, station_tair_filepath, dst_filepath,
          x0_tair_avg_radius, x0_green_area_cooling_dist, x0_w_shade,
-         x0_w_albedo, x0_w_eti, metric, stepsize):
+         x0_w_albedo, x0_w_eti, metric, stepsize, num_candidates, num_chains,
+         x0_stepsize, num_workers, seed):
     logger = logging.getLogger(__name__)
     # disable InVEST's logging
     for module in ('natcap.invest.urban_cooling_model', 'natcap.invest.utils',
@@ -61,21 +67,35 @@ def main(agglom_lulc_filepath, biophysical_table_filepath, ref_et_filepath,
         ]
 
         # client = distributed.Client('tcp://165.22.198.117:8786')
-        ucm_calibrator = iuc.UCMCalibrator(
+        ucm_calibrator = invest_utils.UCMCalibrator(
             agglom_lulc_filepath,
             biophysical_table_filepath,
             'factors',
-            list(ref_et_raster_filepath_dict.values()),
+            invest_utils.get_ref_et_raster_filepaths(
+                ref_et_raster_filepath_dict, station_tair_filepath),
             station_t_filepath=station_tair_filepath,
             station_locations_filepath=station_locations_filepath,
             workspace_dir=workspace_dir,
             # model_params=model_params,
             initial_solution=initial_solution,
             metric=metric,
-            stepsize=stepsize)
+            stepsize=stepsize,
+            num_workers=num_workers,
+            rng=seed)
 
-        # make it happen
-        solution, cost = ucm_calibrator.anneal()
+        # make it happen. Make sure that the process pool is shut down (which
+        # waits for the running tasks) before the workspace is deleted, even
+        # if the annealing fails
+        try:
+            if num_chains > 1:
+                solution, cost = ucm_calibrator.anneal_multistart(
+                    num_chains, num_candidates=num_candidates,
+                    x0_stepsize=x0_stepsize)
+            else:
+                solution, cost = ucm_calibrator.anneal(
+                    num_candidates=num_candidates)
+        finally:
+            ucm_calibrator.close()
     # # delete the tmp dir
     # shutil.rmtree(tmp_dir)
 
@@ -1,18 +1,36 @@
+import copy
+import logging
+import math
+import os
 import tempfile
+import time
+from concurrent import futures
 from os import path
 
+import dask
 import invest_ucm_calibration as iuc
 import numpy as np
+import numpy.random as rn
 import pandas as pd
 import rasterio as rio
 import salem  # noqa: F401
 import xarray as xr
+from natcap.invest import urban_cooling_model as ucm
 from rasterio import transform
+from sklearn import metrics
+
+logger = logging.getLogger(__name__)
+
+# number of decimals to which the calibration states are rounded when caching
+# the energy of the states that have already been evaluated
+ENERGY_CACHE_DECIMALS = 6
 
 
 def _get_ref_eto_filepath(date, dst_dir):
-    return path.join(
-        dst_dir, f'ref_eto_{pd.to_datetime(date).strftime("%Y-%m-%d")}.tif')
+    # `date` must be datetime-like (e.g., `pd.Timestamp`), note that this is
+    # only used when dumping the rasters, afterwards the file paths are
+    # always taken from the returned dict/list
+    return path.join(dst_dir, f'ref_eto_{date:%Y-%m-%d}.tif')
 
 
 def dump_ref_et_rasters(ref_et_filepath, dst_dir):
@@ -33,18 +51,48 @@ def dump_ref_et_rasters(ref_et_filepath, dst_dir):
                 count=1,
                 transform=transform.from_bounds(west, south, east, north,
                                                 width, height),
-                crs=ref_et_da.attrs['pyproj_srs'])
+                crs=ref_et_da.attrs['pyproj_srs'],
+                tiled=True,
+                blockxsize=256,
+                blockysize=256,
+                compress='lzw',
+                predictor=3,
+                BIGTIFF='IF_SAFER')
 
+    # iterate directly over the (C-contiguous) array of each date
+    ref_et_arr = np.ascontiguousarray(
+        ref_et_da.transpose('time', 'y', 'x').values)
     ref_et_raster_filepath_dict = {}
-    for date, ref_et_day_da in ref_et_da.groupby('time'):
+    items = []
+    for i, date in enumerate(pd.to_datetime(ref_et_da['time'].values)):
         ref_et_raster_filepath = _get_ref_eto_filepath(date, dst_dir)
-        with rio.open(ref_et_raster_filepath, 'w', **meta) as dst:
-            dst.write(ref_et_day_da.values, 1)
+        items.append((ref_et_raster_filepath, ref_et_arr[i]))
         ref_et_raster_filepath_dict[date] = ref_et_raster_filepath
 
+    # GDAL releases the GIL while writing, so the rasters can be dumped
+    # concurrently
+    def _write_raster(item):
+        filepath, arr = item
+        with rio.open(filepath, 'w', **meta) as dst:
+            dst.write(arr, 1)
+
+    with futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        list(executor.map(_write_raster, items))
+
     return ref_et_raster_filepath_dict
 
 
+def get_ref_et_raster_filepaths(ref_et_raster_filepath_dict,
+                                station_tair_filepath):
+    # the predictions for each date are matched positionally with the rows of
+    # the station measurements table, so the list of reference
+    # evapotranspiration rasters must follow the same date order (rather
+    # than relying on the order of the dict)
+    dates = pd.to_datetime(
+        pd.read_csv(station_tair_filepath, index_col=0).index)
+    return [ref_et_raster_filepath_dict[date] for date in dates]
+
+
 class UCMWrapper(iuc.UCMWrapper):
     def __init__(self, lulc_raster_filepath, biophysical_table_filepath,
                  ref_et_filepath, station_tair_filepath,
@@ -52,13 +100,456 @@ class UCMWrapper(iuc.UCMWrapper):
         ref_et_dir = tempfile.mkdtemp()
         ref_et_raster_filepath_dict = dump_ref_et_rasters(
             ref_et_filepath, ref_et_dir)
-        self.dates = list(ref_et_raster_filepath_dict.keys())
         super(UCMWrapper, self).__init__(
             lulc_raster_filepath,
             biophysical_table_filepath,
             'factors',
-            list(ref_et_raster_filepath_dict.values()),
+            get_ref_et_raster_filepaths(ref_et_raster_filepath_dict,
+                                        station_tair_filepath),
             station_t_filepath=station_tair_filepath,
             station_locations_filepath=station_locations_filepath,
             extra_ucm_args=extra_ucm_args,
             **kwargs)
+
+    # properties to process the geospatial raster grid: for north-up rasters
+    # (i.e., without rotation), the pixel center coordinates can be computed
+    # directly from the affine transform
+    @property
+    def grid_x(self):
+        try:
+            return self._grid_x
+        except AttributeError:
+            t = self.meta['transform']
+            if t.b == 0 and t.d == 0:
+                self._grid_x = t.c + (np.arange(self.meta['width']) +
+                                      0.5) * t.a
+                return self._grid_x
+            return super(UCMWrapper, self).grid_x
+
+    @property
+    def grid_y(self):
+        try:
+            return self._grid_y
+        except AttributeError:
+            t = self.meta['transform']
+            if t.b == 0 and t.d == 0:
+                self._grid_y = t.f + (np.arange(self.meta['height']) +
+                                      0.5) * t.e
+                return self._grid_y
+            return super(UCMWrapper, self).grid_y
+
+    def predict_t_da(self, ucm_args=None):
+        pred_delayed = [
+            dask.delayed(self.predict_t_arr)(i, ucm_args)
+            for i in range(len(self.ref_et_raster_filepaths))
+        ]
+        t_arrs = list(
+            dask.compute(*pred_delayed, scheduler='processes',
+                         num_workers=self.num_workers))
+
+        if self.dates is None:
+            dates = np.arange(len(self.ref_et_raster_filepaths))
+        else:
+            dates = self.dates
+        t_da = xr.DataArray(t_arrs, dims=('time', 'y', 'x'),
+                            coords={
+                                'time': dates,
+                                'y': self.grid_y,
+                                'x': self.grid_x
+                            }, name='T',
+                            attrs={'pyproj_srs': self.meta['crs'].to_proj4()})
+        # mask all the dates at once (broadcasting the mask over the time
+        # dimension) rather than applying the mask to each date separately
+        return t_da.where(xr.DataArray(self.data_mask, dims=('y', 'x')))
+
+    def get_sample_comparison_df(self, ucm_args=None):
+        T_da = self.predict_t_da(ucm_args=ucm_args)
+        # select the station pixels of all the dates at once, i.e., an array
+        # of shape (n_dates, n_stations)
+        tair_pred_df = pd.DataFrame(
+            T_da.values[:, self.station_rows, self.station_cols],
+            index=T_da['time'].values,
+            columns=self.station_tair_df.columns)
+
+        return pd.concat([self.station_tair_df.stack(),
+                          tair_pred_df.stack()],
+                         axis=1).reset_index().rename(columns={
+                             'level_0': 'date',
+                             'level_1': 'station',
+                             0: 'obs',
+                             1: 'pred'
+                         })
+
+
+# read-only state shared by all the calibration tasks run in a worker process,
+# set up once per worker (see `_init_worker`) so that it does not need to be
+# pickled for each task
+_WORKER_STATE = {}
+
+
+def _init_worker(base_args, ref_et_raster_filepaths, t_refs, uhi_maxs,
+                 station_xys):
+    _WORKER_STATE.update(base_args=base_args,
+                         ref_et_raster_filepaths=ref_et_raster_filepaths,
+                         t_refs=t_refs,
+                         uhi_maxs=uhi_maxs,
+                         station_xys=station_xys)
+
+
+def _predict_t_date(i, ucm_args, workspace_subdir=''):
+    # predict the temperature samples for the i-th calibration date, i.e.,
+    # the pixels of the station locations if calibrating against station
+    # measurements, or the whole raster otherwise (as in
+    # `iuc.UCMWrapper.predict_t_arr`)
+    base_args = _WORKER_STATE['base_args']
+    args = base_args.copy()
+    args.update(ucm_args)
+    # note that this workspace_dir corresponds to this date only. It must
+    # remain the same across iterations, since the urban cooling model runs
+    # its stages through a taskgraph cached in the workspace, so that the
+    # intermediate rasters that do not depend on the calibrated parameters
+    # (e.g., the aligned LULC and reference evapotranspiration rasters and
+    # the biophysical table reclassifications) are not recomputed. Concurrent
+    # runs (i.e., candidates and annealing chains) use a separate
+    # `workspace_subdir` each
+    args.update(
+        workspace_dir=path.join(base_args['workspace_dir'], workspace_subdir,
+                                str(i)),
+        ref_eto_raster_path=_WORKER_STATE['ref_et_raster_filepaths'][i],
+        t_ref=_WORKER_STATE['t_refs'][i],
+        uhi_max=_WORKER_STATE['uhi_maxs'][i])
+    ucm.execute(args)
+
+    station_xys = _WORKER_STATE['station_xys']
+    with rio.open(
+            path.join(args['workspace_dir'], 'intermediate',
+                      'T_air.tif')) as src:
+        if station_xys is None:
+            return src.read(1)
+        # only sample the station pixels rather than reading the whole
+        # raster
+        return np.fromiter((values[0]
+                            for values in src.sample(station_xys)),
+                           dtype=src.dtypes[0], count=len(station_xys))
+
+
+def _mean_squared_error(obs, pred):
+    # same as `metrics.mean_squared_error` (with the default `squared=True`)
+    # without the input validation overhead
+    d = obs - pred
+    return float(d @ d) / d.size
+
+
+def _compute_accept_prob(energy, new_energy, T):
+    # probability of accepting a move that changes the energy from `energy`
+    # to `new_energy` at the temperature `T`
+    if new_energy <= energy:
+        return 1.0
+    return math.exp(-(new_energy - energy) / T)
+
+
+def _metropolis_step(energy, new_energy, T, u):
+    # whether the move is accepted, where `u` is a random number drawn from
+    # the uniform distribution over [0, 1)
+    return _compute_accept_prob(energy, new_energy, T) >= u
+
+
+class UCMCalibrator(iuc.UCMCalibrator):
+    def __init__(self, *args, rng=None, **kwargs):
+        super(UCMCalibrator, self).__init__(*args, **kwargs)
+        # random number generator of this calibrator (rather than the global
+        # one of `numpy.random`), which can be either an integer seed or an
+        # object with an `uniform` method, e.g., `numpy.random.RandomState`
+        # (or `numpy.random.Generator` in numpy>=1.17)
+        if rng is None or isinstance(rng, (int, np.integer)):
+            rng = rn.RandomState(rng)
+        self.rng = rng
+        # cache of the energy of the evaluated states (each evaluation
+        # requires running the urban cooling model for all the dates)
+        self._energy_cache = {}
+        # when calibrating against station measurements, precompute the
+        # station coordinates (of the pixel centers) to sample the predicted
+        # temperature rasters
+        if hasattr(self.ucm_wrapper, 'station_rows'):
+            self.station_xys = list(
+                zip(*transform.xy(self.ucm_wrapper.meta['transform'],
+                                  self.ucm_wrapper.station_rows,
+                                  self.ucm_wrapper.station_cols)))
+        else:
+            self.station_xys = None
+        # the predicted temperature rasters are float32, so we also use
+        # single precision for the observations rather than upcasting the
+        # predictions (the loss of precision in the metrics is negligible
+        # with respect to the accuracy of the model)
+        self._obs_arr = self.ucm_wrapper.obs_arr.astype(np.float32)
+        if self.compute_metric is metrics.mean_squared_error:
+            self.compute_metric = _mean_squared_error
+        # buffer where the predicted temperatures (of all the dates) are
+        # written, so that it is not allocated at each iteration. The number
+        # of rows corresponds to the number of states evaluated at once, and
+        # is increased if needed
+        self._num_date_samples = self.ucm_wrapper.obs_mask.size // len(
+            self.ucm_wrapper.ref_et_raster_filepaths)
+        self._pred_buf = np.empty((1, self.ucm_wrapper.obs_mask.size),
+                                  dtype=np.float32)
+        # subdirectory of the workspace where the model is run (only set for
+        # the chains of `anneal_multistart`)
+        self._workspace_subdir = ''
+        # calibrator that spawned this one as a chain of `anneal_multistart`,
+        # so that the chains also stop when the user interrupts the parent
+        # (the SIGINT handler of `simanneal.Annealer` is bound to the parent)
+        self._parent = None
+        # process pool that is reused by all the iterations, so that we do
+        # not start a new pool every time that the energy is evaluated
+        self._pool = futures.ProcessPoolExecutor(
+            max_workers=self.ucm_wrapper.num_workers,
+            initializer=_init_worker,
+            initargs=(self.ucm_wrapper.base_args,
+                      list(self.ucm_wrapper.ref_et_raster_filepaths),
+                      list(self.ucm_wrapper.t_refs),
+                      list(self.ucm_wrapper.uhi_maxs), self.station_xys))
+
+    def copy_state(self, state):
+        # the state is kept as a float numpy array (whatever the list-like
+        # passed as initial solution), so we can copy it without resorting to
+        # `copy.deepcopy`
+        return np.array(state, dtype=float)
+
+    def close(self):
+        # shut down the process pool
+        self._pool.shutdown()
+
+    def _predict_t(self, ucm_args_seq):
+        # predict the temperature samples for all the calibration dates and
+        # all the arguments in `ucm_args_seq` at once in the process pool.
+        # Each candidate (i.e., position in `ucm_args_seq`) runs in its own
+        # workspace subdirectory, so that no two concurrent runs share a
+        # workspace, yet each workspace remains stable across iterations
+        num_dates = len(self.ucm_wrapper.ref_et_raster_filepaths)
+        pred_futures = [[
+            self._pool.submit(
+                _predict_t_date, i, ucm_args,
+                path.join(self._workspace_subdir, f'candidate-{k}'))
+            for i in range(num_dates)
+        ] for k, ucm_args in enumerate(ucm_args_seq)]
+
+        # write the predictions of each date at its offset of the buffer
+        num_states = len(pred_futures)
+        if self._pred_buf.shape[0] < num_states:
+            self._pred_buf = np.empty((num_states, self._pred_buf.shape[1]),
+                                      dtype=np.float32)
+        n = self._num_date_samples
+        for k, date_futures in enumerate(pred_futures):
+            for i, future in enumerate(date_futures):
+                self._pred_buf[k, i * n:(i + 1) * n] = future.result().ravel()
+        return self._pred_buf[:num_states]
+
+    def _get_neighbours(self, state, num_neighbours, stepsize=None):
+        # perturb all the parameters of all the neighbours with a single call
+        # to the random number generator
+        if stepsize is None:
+            stepsize = self.stepsize
+        state = np.asarray(state, dtype=float)
+        neighbours = state * (1 + self.rng.uniform(
+            -stepsize, stepsize, size=(num_neighbours, len(state))))
+        # ensure that kernel decay distances are of at least one pixel
+        if self.exclude_zero_kernel_dist:
+            neighbours[:, :2] = np.maximum(neighbours[:, :2],
+                                           self.min_kernel_dist)
+        # rescale so that the three weights add up to one
+        neighbours[:, 2:] /= neighbours[:, 2:].sum(axis=1, keepdims=True)
+
+        return neighbours
+
+    def move(self):
+        self.state = self._get_neighbours(self.state, 1)[0]
+
+    def _energy_batch(self, states):
+        # a proposal that has already been evaluated (either accepted or
+        # rejected) does not need to go through the model again. The rounded
+        # state is only used as the cache key, the model is run with the
+        # actual state
+        keys = [
+            tuple(np.round(state, ENERGY_CACHE_DECIMALS)) for state in states
+        ]
+        new_states = {}
+        for key, state in zip(keys, states):
+            if key not in self._energy_cache:
+                new_states.setdefault(key, state)
+        new_keys = list(new_states)
+        if new_keys:
+            pred_arrs = self._predict_t([
+                dict(zip(iuc.settings.DEFAULT_UCM_PARAMS, new_states[key]))
+                for key in new_keys
+            ])
+            for key, pred_arr in zip(new_keys, pred_arrs):
+                self._energy_cache[key] = self.compute_metric(
+                    self._obs_arr, pred_arr[self.ucm_wrapper.obs_mask])
+
+        return np.array([self._energy_cache[key] for key in keys])
+
+    def energy(self):
+        return self._energy_batch([self.state])[0]
+
+    def _is_user_exit(self):
+        return self.user_exit or (self._parent is not None
+                                  and self._parent._is_user_exit())
+
+    def update(self, step, T, E, acceptance, improvement):
+        # log the progress through `logging` rather than printing to stderr
+        # (as in `simanneal.Annealer.default_update`), so that the messages
+        # are only formatted if the logging level is enabled. The chains of
+        # `anneal_multistart` log concurrently, so their messages are
+        # prefixed with the chain label (i.e., the workspace subdirectory)
+        if self._workspace_subdir:
+            prefix = f'{self._workspace_subdir} '
+        else:
+            prefix = ''
+        if acceptance is None:
+            logger.info("%sstep %d/%d: T=%.5f, E=%.5f", prefix, step,
+                        self.steps, T, E)
+        else:
+            logger.info(
+                "%sstep %d/%d: T=%.5f, E=%.5f, accepted=%.2f, improved=%.2f",
+                prefix, step, self.steps, T, E, acceptance, improvement)
+
+    def anneal(self, num_candidates=1):
+        # same procedure as `simanneal.Annealer.anneal`, but additionally
+        # keeping the history of accepted states and energies in preallocated
+        # arrays (stored in the `states` and `energies` attributes). At each
+        # step, `num_candidates` neighbours are evaluated at once (so that
+        # the process pool is better used), the Metropolis criterion is
+        # applied to each of them and the best accepted candidate (if any)
+        # becomes the new state
+        if num_candidates < 1:
+            raise ValueError('The number of candidates must be at least 1.')
+
+        step = 0
+        self.start = time.time()
+        # `calibrate` may have set the state as any list-like
+        self.state = self.copy_state(self.state)
+
+        # precompute factor for exponential cooling from Tmax to Tmin
+        if self.Tmin <= 0.0:
+            raise ValueError('Exponential cooling requires a minimum '
+                             'temperature greater than zero.')
+        Tfactor = -math.log(self.Tmax / self.Tmin)
+
+        # note initial state
+        T = self.Tmax
+        E = self.energy()
+        prev_state = self.copy_state(self.state)
+        prev_energy = E
+        self.best_state = self.copy_state(self.state)
+        self.best_energy = E
+        states = np.empty((self.steps + 1, len(self.state)))
+        energies = np.empty(self.steps + 1)
+        states[0] = self.state
+        energies[0] = E
+        num_accepted = 1
+        trials, accepts, improves = 0, 0, 0
+        if self.updates > 0:
+            update_wavelength = self.steps / self.updates
+            self.update(step, T, E, None, None)
+
+        # attempt moves to new states
+        while step < self.steps and not self._is_user_exit():
+            step += 1
+            T = self.Tmax * math.exp(Tfactor * step / self.steps)
+            candidates = self._get_neighbours(prev_state, num_candidates)
+            candidate_energies = self._energy_batch(candidates)
+            us = self.rng.uniform(size=num_candidates)
+            accepted = [
+                _metropolis_step(prev_energy, candidate_energy, T, u)
+                for candidate_energy, u in zip(candidate_energies, us)
+            ]
+            trials += 1
+            if not any(accepted):
+                # keep previous state
+                self.state = self.copy_state(prev_state)
+                E = prev_energy
+            else:
+                # accept the best accepted candidate and compare to best state
+                k = np.flatnonzero(accepted)[np.argmin(
+                    candidate_energies[accepted])]
+                self.state = candidates[k]
+                E = candidate_energies[k]
+                accepts += 1
+                if E < prev_energy:
+                    improves += 1
+                prev_state = self.copy_state(self.state)
+                prev_energy = E
+                states[num_accepted] = self.state
+                energies[num_accepted] = E
+                num_accepted += 1
+                if E < self.best_energy:
+                    self.best_state = self.copy_state(self.state)
+                    self.best_energy = E
+            if self.updates > 1:
+                if (step // update_wavelength) > (
+                        (step - 1) // update_wavelength):
+                    self.update(step, T, E, accepts / trials,
+                                improves / trials)
+                    trials, accepts, improves = 0, 0, 0
+
+        self.states = states[:num_accepted]
+        self.energies = energies[:num_accepted]
+        self.state = self.copy_state(self.best_state)
+        if self.save_state_on_exit:
+            self.save_state()
+
+        # return best state and energy
+        return self.best_state, self.best_energy
+
+    def anneal_multistart(self, num_chains, num_candidates=1,
+                          x0_stepsize=None):
+        # run `num_chains` independent annealing chains concurrently and
+        # return the best state and energy among all of them. The first chain
+        # starts from the current state, the others from neighbours of it
+        # drawn with `x0_stepsize` (which defaults to `stepsize`). A larger
+        # `x0_stepsize` spreads the starting points further apart, yet it
+        # should be lower than 1 so that the parameters stay positive. Each
+        # chain has its own random number generator, seeded from the
+        # generator of this calibrator, and its own workspace subdirectory.
+        # The chains run in threads, since the urban cooling model is run in
+        # the (shared) process pool anyway. The size of the pool (i.e., the
+        # `num_workers` argument) should thus account for the number of
+        # chains
+        if num_chains < 1:
+            raise ValueError('The number of chains must be at least 1.')
+        if num_candidates < 1:
+            raise ValueError('The number of candidates must be at least 1.')
+
+        x0s = np.vstack([
+            self.state,
+            self._get_neighbours(self.state, num_chains - 1,
+                                 stepsize=x0_stepsize)
+        ])
+        seeds = (self.rng.uniform(size=num_chains) *
+                 np.iinfo(np.uint32).max).astype(np.uint32)
+
+        chains = []
+        for k, (x0, seed) in enumerate(zip(x0s, seeds)):
+            chain = copy.copy(self)
+            chain.state = x0
+            chain.rng = rn.RandomState(seed)
+            chain._workspace_subdir = f'chain-{k}'
+            chain._pred_buf = np.empty_like(self._pred_buf)
+            chain._parent = self
+            chains.append(chain)
+
+        with futures.ThreadPoolExecutor(max_workers=num_chains) as executor:
+            results = list(
+                executor.map(
+                    lambda chain: chain.anneal(num_candidates=num_candidates),
+                    chains))
+
+        best_chain, (best_state, best_energy) = min(
+            zip(chains, results), key=lambda chain_result: chain_result[1][1])
+        self.states = best_chain.states
+        self.energies = best_chain.energies
+        self.best_state = best_state
+        self.best_energy = best_energy
+        self.state = self.copy_state(best_state)
+
+        return self.best_state, self.best_energy